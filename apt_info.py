@@ -16,112 +16,168 @@ This, for example, will enable a nightly job that runs `apt update`:
 
 See /usr/lib/apt/apt.systemd.daily for details.
 
+Packages can be left out of the upgrade and autoremoval metrics with
+`--exclude`, for example packages which are deliberately kept at an
+older version:
+
+    apt_info.py --exclude linux-image-generic linux-headers-generic
+
 Dependencies: python3-apt, python3-prometheus-client
 
 Authors: Kyle Fazzari <kyrofa@ubuntu.com>
          Daniel Swarbrick <dswarbrick@debian.org>
 """
 
-import apt
-import apt_pkg
+import argparse
 import collections
 import os
-from prometheus_client import CollectorRegistry, Gauge, generate_latest
+import sys
+from prometheus_client import CollectorRegistry, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+_UpgradeInfo = collections.namedtuple("_UpgradeInfo", ["origin", "arch", "count"])
+
 
-_UpgradeInfo = collections.namedtuple("_UpgradeInfo", ["labels", "count"])
+class _StaticCollector:
+    """Collector returning metric families that have been filled in already."""
+
+    def __init__(self, *families):
+        self._families = families
+
+    def collect(self):
+        return self._families
 
 
 def _convert_candidates_to_upgrade_infos(candidates):
-    changes_dict = collections.defaultdict(lambda: collections.defaultdict(int))
+    # Most candidates come from one of a handful of package file combinations,
+    # so only format the origins of each distinct combination once. Package
+    # files are identified by their cache ID, which is cheaper to read than
+    # the origin fields themselves.
+    origin_keys = {}
+    changes = collections.Counter()
 
     for candidate in candidates:
-        origins = sorted(
-            {f"{o.origin}:{o.codename}/{o.archive}" for o in candidate.origins}
-        )
-        changes_dict[",".join(origins)][candidate.architecture] += 1
-
-    changes_list = list()
-    for origin in sorted(changes_dict.keys()):
-        for arch in sorted(changes_dict[origin].keys()):
-            changes_list.append(
-                _UpgradeInfo(
-                    labels=dict(origin=origin, arch=arch),
-                    count=changes_dict[origin][arch],
-                )
-            )
-
-    return changes_list
-
-
-def _write_pending_upgrades(registry, cache):
-    candidates = {
-        p.candidate for p in cache if p.is_upgradable
-    }
-    upgrade_list = _convert_candidates_to_upgrade_infos(candidates)
+        file_list = candidate.file_list
+        file_ids = tuple(pf.id for pf, _ in file_list)
+        origin_key = origin_keys.get(file_ids)
+        if origin_key is None:
+            origin_key = origin_keys[file_ids] = sys.intern(",".join(sorted(
+                {f"{pf.origin}:{pf.codename}/{pf.archive}" for pf, _ in file_list}
+            )))
+        changes[origin_key, candidate.arch] += 1
+
+    # A single sort over the (origin, arch) keys yields the same ordering as
+    # sorting by origin and then by arch within each origin.
+    return [
+        _UpgradeInfo(origin, arch, count) for (origin, arch), count in sorted(changes.items())
+    ]
+
+
+def _write_pending_upgrades(registry, upgradable_candidates):
+    upgrade_list = _convert_candidates_to_upgrade_infos(upgradable_candidates)
 
     if upgrade_list:
-        g = Gauge('apt_upgrades_pending', "Apt packages pending updates by origin",
-                  ['origin', 'arch'], registry=registry)
+        g = GaugeMetricFamily('apt_upgrades_pending', "Apt packages pending updates by origin",
+                              labels=['origin', 'arch'])
         for change in upgrade_list:
-            g.labels(change.labels['origin'], change.labels['arch']).set(change.count)
+            g.add_metric([change.origin, change.arch], change.count)
+        registry.register(_StaticCollector(g))
 
 
-def _write_held_upgrades(registry, cache):
-    held_candidates = {
-        p.candidate for p in cache
-        if p.is_upgradable and p._pkg.selected_state == apt_pkg.SELSTATE_HOLD
-    }
+def _write_held_upgrades(registry, held_candidates):
     upgrade_list = _convert_candidates_to_upgrade_infos(held_candidates)
 
     if upgrade_list:
-        g = Gauge('apt_upgrades_held', "Apt packages pending updates but held back.",
-                  ['origin', 'arch'], registry=registry)
+        g = GaugeMetricFamily('apt_upgrades_held', "Apt packages pending updates but held back.",
+                              labels=['origin', 'arch'])
         for change in upgrade_list:
-            g.labels(change.labels['origin'], change.labels['arch']).set(change.count)
-
-
-def _write_autoremove_pending(registry, cache):
-    autoremovable_packages = {p for p in cache if p.is_auto_removable}
-    g = Gauge('apt_autoremove_pending', "Apt packages pending autoremoval.",
-              registry=registry)
-    g.set(len(autoremovable_packages))
-
-
-def _write_cache_timestamps(registry):
-    g = Gauge('apt_package_cache_timestamp_seconds', "Apt update last run time.", registry=registry)
-    apt_pkg.init_config()
-    if (
-        apt_pkg.config.find_b("APT::Periodic::Update-Package-Lists") and
-        os.path.isfile("/var/lib/apt/periodic/update-success-stamp")
-    ):
-        # if we run updates automatically with APT::Periodic, we can
-        # check this timestamp file if it exists
-        stamp_file = "/var/lib/apt/periodic/update-success-stamp"
-    else:
-        # if not, let's just fallback on the partial file of the lists directory
-        stamp_file = '/var/lib/apt/lists/partial'
-    try:
-        g.set(os.stat(stamp_file).st_mtime)
-    except OSError:
-        pass
+            g.add_metric([change.origin, change.arch], change.count)
+        registry.register(_StaticCollector(g))
+
+
+def _write_autoremove_pending(registry, autoremovable_packages):
+    g = GaugeMetricFamily('apt_autoremove_pending', "Apt packages pending autoremoval.",
+                          value=len(autoremovable_packages))
+    registry.register(_StaticCollector(g))
+
+
+def _write_cache_timestamps(registry, periodic_update):
+    # if we run updates automatically with APT::Periodic, we can check this
+    # timestamp file if it exists; if not, let's just fallback on the partial
+    # file of the lists directory
+    stamp_files = ['/var/lib/apt/lists/partial']
+    if periodic_update:
+        stamp_files.insert(0, "/var/lib/apt/periodic/update-success-stamp")
+
+    timestamp = 0
+    for stamp_file in stamp_files:
+        try:
+            timestamp = os.stat(stamp_file).st_mtime
+        except OSError:
+            continue
+        break
+
+    g = GaugeMetricFamily('apt_package_cache_timestamp_seconds', "Apt update last run time.",
+                          value=timestamp)
+    registry.register(_StaticCollector(g))
 
 
 def _write_reboot_required(registry):
-    g = Gauge('node_reboot_required', "Node reboot is required for software updates.",
-              registry=registry)
-    g.set(int(os.path.isfile('/run/reboot-required')))
+    g = GaugeMetricFamily('node_reboot_required', "Node reboot is required for software updates.",
+                          value=int(os.path.isfile('/run/reboot-required')))
+    registry.register(_StaticCollector(g))
 
 
 def _main():
-    cache = apt.cache.Cache()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--exclude', nargs='*', default=[], metavar='PACKAGE',
+                        help="Package names to exclude from the metrics")
+    args = parser.parse_args()
+
+    # Deferred until after argument parsing, so that --help and usage errors
+    # don't pay for loading python-apt.
+    import apt_pkg
+
+    # Use the low-level apt_pkg bindings directly, rather than apt.cache.Cache,
+    # which builds a Python wrapper object for every package in the cache.
+    apt_pkg.init()
+    cache = apt_pkg.Cache(None)
+    depcache = apt_pkg.DepCache(cache)
+
+    # Resolve the excluded package names to their cache IDs up front, so that
+    # the loop below only compares integers.
+    excluded_ids = frozenset(cache[name].id for name in args.exclude if name in cache)
+
+    # Classify all packages in a single pass over the cache. The depcache
+    # methods are bound once, as the loop visits every package on the system.
+    is_upgradable = depcache.is_upgradable
+    is_garbage = depcache.is_garbage
+    get_candidate_ver = depcache.get_candidate_ver
+    upgradable_candidates = []
+    held_candidates = []
+    autoremovable_packages = []
+    for pkg in cache.packages:
+        # Only installed packages can be upgradable or auto-removable.
+        if pkg.current_ver is None:
+            continue
+        if excluded_ids and pkg.id in excluded_ids:
+            continue
+        if is_upgradable(pkg):
+            candidate = get_candidate_ver(pkg)
+            upgradable_candidates.append(candidate)
+            if pkg.selected_state == apt_pkg.SELSTATE_HOLD:
+                held_candidates.append(candidate)
+        if is_garbage(pkg):
+            autoremovable_packages.append(pkg)
 
     registry = CollectorRegistry()
-    _write_pending_upgrades(registry, cache)
-    _write_held_upgrades(registry, cache)
-    _write_autoremove_pending(registry, cache)
-    _write_cache_timestamps(registry)
+    _write_pending_upgrades(registry, upgradable_candidates)
+    _write_held_upgrades(registry, held_candidates)
+    _write_autoremove_pending(registry, autoremovable_packages)
+    _write_cache_timestamps(
+        registry, apt_pkg.config.find_b("APT::Periodic::Update-Package-Lists"))
     _write_reboot_required(registry)
-    print(generate_latest(registry).decode(), end='')
+    sys.stdout.buffer.write(generate_latest(registry))
 
 
 if __name__ == "__main__":
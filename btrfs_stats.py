@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 
 # Collect per-device btrfs filesystem errors. Designed to work on Debian and Centos 6 and later.
-# Requires btrfs-progs package to be installed.
+# Error counters are read from sysfs where possible; btrfs-progs is required for multi-device
+# filesystems and for kernels older than 5.14, which do not expose them there.
 #
 # Consider using node_exporter's built-in btrfs collector instead of this script.
 
@@ -9,23 +10,119 @@ import glob
 import os.path
 import re
 import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from prometheus_client import CollectorRegistry, Gauge, generate_latest
 
 
-DEVICE_PATTERN = re.compile(r"^\[([^\]]+)\]\.(\S+)\s+(\d+)$")
+DEVICE_PATTERN = re.compile(r"^\[([^\]]+)\]\.(\S+)\s+(\d+)$", re.MULTILINE)
+
+# Map the counter names in sysfs error_stats files to those reported by `btrfs device stats`.
+SYSFS_ERROR_TYPES = {
+    'write_errs': 'write_io_errs',
+    'read_errs': 'read_io_errs',
+    'flush_errs': 'flush_io_errs',
+    'corruption_errs': 'corruption_errs',
+    'generation_errs': 'generation_errs',
+}
+
+ALLOCATION_TYPES = ('data', 'metadata', 'system')
+
+
+def read_sysfs_int(path):
+    """Read an integer value from a sysfs attribute file.
+
+    Uses unbuffered os-level I/O, which avoids setting up a file object for what is a single
+    small read.
+
+    Args:
+        path: (string) path to the sysfs attribute.
+
+    Returns:
+        (int) value of the attribute.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        # int() ignores the trailing newline.
+        return int(os.read(fd, 32))
+    finally:
+        os.close(fd)
 
 
 def get_btrfs_mount_points():
     """List all btrfs mount points.
 
     Yields:
-        (string) filesystem mount points.
+        (mountpoint, device) tuples, where:
+            mountpoint: (string) filesystem mount point.
+            device: (string) path to the block device that was mounted.
     """
     with open("/proc/mounts") as f:
         for line in f:
             parts = line.split()
             if parts[2] == "btrfs":
-                yield parts[1]
+                yield parts[1], parts[0]
+
+
+def get_btrfs_filesystems():
+    """List all btrfs mount points along with the sysfs directory of their filesystem.
+
+    The sysfs directories are indexed by device number once, rather than being searched for
+    each mount point.
+
+    Returns:
+        List of (mountpoint, device, fs_dir) tuples, where:
+            mountpoint: (string) filesystem mount point.
+            device: (string) path to the block device that was mounted.
+            fs_dir: (string) path to the filesystem's directory below /sys/fs/btrfs, or None if
+                it could not be determined.
+    """
+    fs_dirs = {}
+    for dev_file in glob.glob("/sys/fs/btrfs/*/devices/*/dev"):
+        with open(dev_file) as f:
+            fs_dirs[f.read().strip()] = dev_file.rsplit("/devices/", 1)[0]
+
+    filesystems = []
+    for mountpoint, device in get_btrfs_mount_points():
+        try:
+            rdev = os.stat(device).st_rdev
+        except OSError:
+            fs_dir = None
+        else:
+            fs_dir = fs_dirs.get("{}:{}".format(os.major(rdev), os.minor(rdev)))
+        filesystems.append((mountpoint, device, fs_dir))
+    return filesystems
+
+
+def get_sysfs_btrfs_errors(fs_dir, device):
+    """Get per-device errors for a btrfs filesystem from sysfs.
+
+    sysfs keeps the error counters per device ID, without a link to the corresponding block
+    device, so only single-device filesystems can be attributed unambiguously.
+
+    Args:
+        fs_dir: (string) path to the filesystem's directory below /sys/fs/btrfs.
+        device: (string) path to the block device that was mounted, which is the path reported
+            by btrfs-progs for a single-device filesystem.
+
+    Returns:
+        List of (device, error_type, error_count) tuples as yielded by get_btrfs_errors, or None
+        if the errors cannot be read from sysfs.
+    """
+    devices = os.listdir(os.path.join(fs_dir, "devices"))
+    error_stats = glob.glob(os.path.join(fs_dir, "devinfo/*/error_stats"))
+    if len(devices) != 1 or len(error_stats) != 1:
+        return None
+
+    errors = []
+    with open(error_stats[0]) as f:
+        for line in f:
+            # Sample line:
+            # write_errs 0
+            error_type, error_count = line.split()
+            errors.append((device, SYSFS_ERROR_TYPES.get(error_type, error_type),
+                           int(error_count)))
+    return errors
 
 
 def get_btrfs_errors(mountpoint):
@@ -45,15 +142,15 @@ def get_btrfs_errors(mountpoint):
     stdout, stderr = p.communicate()
     if p.returncode != 0:
         raise RuntimeError("btrfs returned exit code %d" % p.returncode)
-    for line in stdout.splitlines():
-        if not line:
-            continue
-        # Sample line:
-        # [/dev/vdb1].flush_io_errs   0
-        m = DEVICE_PATTERN.match(line.decode("utf-8"))
-        if not m:
-            raise RuntimeError("unexpected output from btrfs: '%s'" % line)
+    # Sample line:
+    # [/dev/vdb1].flush_io_errs   0
+    output = stdout.decode("utf-8")
+    found = False
+    for m in DEVICE_PATTERN.finditer(output):
+        found = True
         yield m.group(1), m.group(2), int(m.group(3))
+    if not found:
+        raise RuntimeError("unexpected output from btrfs: '%s'" % output)
 
 
 def btrfs_error_metrics(registry):
@@ -62,8 +159,26 @@ def btrfs_error_metrics(registry):
               ['mountpoint', 'device', 'type'],
               namespace='node_btrfs', registry=registry)
 
-    for mountpoint in get_btrfs_mount_points():
-        for device, error_type, error_count in get_btrfs_errors(mountpoint):
+    results = []
+    fallback = []
+    for mountpoint, device, fs_dir in get_btrfs_filesystems():
+        errors = get_sysfs_btrfs_errors(fs_dir, device) if fs_dir else None
+        if errors is None:
+            fallback.append(mountpoint)
+        else:
+            results.append((mountpoint, errors))
+
+    # Each `btrfs device stats` call blocks on ioctls, so run them concurrently
+    # when more than one filesystem has to go through btrfs-progs.
+    if len(fallback) > 1:
+        with ThreadPoolExecutor(max_workers=min(8, len(fallback))) as executor:
+            results.extend(zip(fallback, executor.map(
+                lambda mp: list(get_btrfs_errors(mp)), fallback)))
+    else:
+        results.extend((mp, get_btrfs_errors(mp)) for mp in fallback)
+
+    for mountpoint, errors in results:
+        for device, error_type, error_count in errors:
             g.labels(mountpoint, device, error_type).set(error_count)
 
 
@@ -78,24 +193,23 @@ def btrfs_allocation_metrics(registry):
         'disk_used_bytes': 'disk_used',
     }
 
-    metrics = {}
+    gauges = []
     for m, f in metric_to_filename.items():
-        metrics[m] = Gauge(m, 'btrfs allocation data ({})'.format(f),
-                           ['fs', 'type'],
-                           namespace='node_btrfs', subsystem='allocation', registry=registry)
+        g = Gauge(m, 'btrfs allocation data ({})'.format(f),
+                  ['fs', 'type'],
+                  namespace='node_btrfs', subsystem='allocation', registry=registry)
+        gauges.append((g, f))
 
     for alloc in glob.glob("/sys/fs/btrfs/*/allocation"):
         fs = os.path.basename(os.path.dirname(alloc))
-        for type_ in ('data', 'metadata', 'system'):
-            for m, f in metric_to_filename.items():
-                filename = os.path.join(alloc, type_, f)
-                with open(filename) as f:
-                    value = int(f.read().strip())
-                    metrics[m].labels(fs, type_).set(value)
+        for type_ in ALLOCATION_TYPES:
+            type_dir = os.path.join(alloc, type_)
+            for g, f in gauges:
+                g.labels(fs, type_).set(read_sysfs_int(os.path.join(type_dir, f)))
 
 
 if __name__ == "__main__":
     registry = CollectorRegistry()
     btrfs_error_metrics(registry)
     btrfs_allocation_metrics(registry)
-    print(generate_latest(registry).decode(), end='')
+    sys.stdout.buffer.write(generate_latest(registry))
@@ -58,7 +58,7 @@ def main():
               registry=registry)
     g.set(chrony_tracking[5])
 
-    print(generate_latest(registry).decode("utf-8"), end='')
+    sys.stdout.buffer.write(generate_latest(registry))
 
 
 if __name__ == "__main__":
@@ -7,64 +7,88 @@ The aim is to discover processes that are still using libraries that have since
 been updated, perhaps due security vulnerabilities.
 """
 
+import collections
 import errno
 import glob
 import os
+import re
 import sys
-from prometheus_client import CollectorRegistry, Gauge, generate_latest
+from concurrent.futures import ThreadPoolExecutor
+from prometheus_client import CollectorRegistry, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+_MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Sample line:
+# 7f1e2c000000-7f1e2c021000 r-xp 00000000 fd:01 1234 /usr/lib/libfoo.so.1 (deleted)
+DELETED_LIBRARY_PATTERN = re.compile(
+    rb'^\S+ +\S+ +\S+ +\S+ +\S+ +(\S*/lib/\S*) \(deleted\)$', re.MULTILINE)
+
+
+class _StaticCollector:
+    """Collector returning metric families that have been filled in already."""
+
+    def __init__(self, *families):
+        self._families = families
+
+    def collect(self):
+        return self._families
+
+
+def read_file(path):
+    """Read a whole file, without the overhead of a buffered file object."""
+    chunks = []
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        # procfs may return less than requested, so read until EOF.
+        while True:
+            chunk = os.read(fd, 1 << 20)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        os.close(fd)
+    return b''.join(chunks)
+
+
+def scan_maps(path):
+    """Return the set of deleted libraries mapped by a process."""
+    try:
+        data = read_file(path)
+    except EnvironmentError as e:
+        # Ignore non-existent files, since the files may have changed since
+        # we globbed.
+        if e.errno != errno.ENOENT:
+            sys.exit('Failed to open file: {0}'.format(path))
+        return set()
+
+    # Most processes do not map any deleted file, skip parsing those entirely.
+    if b'(deleted)' not in data:
+        return set()
+
+    return set(DELETED_LIBRARY_PATTERN.findall(data))
 
 
 def main():
-    processes_linking_deleted_libraries = {}
-
-    for path in glob.glob('/proc/*/maps'):
-        try:
-            with open(path, 'rb') as file:
-                for line in file:
-                    part = line.decode().strip().split()
-
-                    if len(part) == 7:
-                        library = part[5]
-                        comment = part[6]
-
-                        if '/lib/' in library and '(deleted)' in comment:
-                            if path not in processes_linking_deleted_libraries:
-                                processes_linking_deleted_libraries[path] = {}
-
-                                if library in processes_linking_deleted_libraries[path]:
-                                    processes_linking_deleted_libraries[path][library] += 1
-                                else:
-                                    processes_linking_deleted_libraries[path][library] = 1
-        except EnvironmentError as e:
-            # Ignore non-existent files, since the files may have changed since
-            # we globbed.
-            if e.errno != errno.ENOENT:
-                sys.exit('Failed to open file: {0}'.format(path))
-
-    num_processes_per_library = {}
-
-    for process, library_count in processes_linking_deleted_libraries.items():
-        libraries_seen = set()
-        for library, count in library_count.items():
-            if library in libraries_seen:
-                continue
-
-            libraries_seen.add(library)
-            if library in num_processes_per_library:
-                num_processes_per_library[library] += 1
-            else:
-                num_processes_per_library[library] = 1
+    num_processes_per_library = collections.Counter()
+
+    # Reading procfs files is mostly spent in the kernel, outside of the GIL.
+    with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+        for libraries in executor.map(scan_maps, glob.glob('/proc/*/maps')):
+            # Count each library at most once per process.
+            num_processes_per_library.update(libraries)
 
     registry = CollectorRegistry()
-    g = Gauge('node_processes_linking_deleted_libraries',
-              'Count of running processes that link a deleted library',
-              ['library_path', 'library_name'], registry=registry)
+    g = GaugeMetricFamily('node_processes_linking_deleted_libraries',
+                          'Count of running processes that link a deleted library',
+                          labels=['library_path', 'library_name'])
 
     for library, count in num_processes_per_library.items():
-        dir_path, basename = os.path.split(library)
-        g.labels(dir_path, basename).set(count)
+        dir_path, basename = os.path.split(library.decode())
+        g.add_metric([dir_path, basename], count)
+    registry.register(_StaticCollector(g))
 
-    print(generate_latest(registry).decode(), end='')
+    sys.stdout.buffer.write(generate_latest(registry))
 
 
 if __name__ == "__main__":
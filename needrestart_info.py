@@ -14,7 +14,6 @@ Authors: RomainMou
 import sys
 import time
 import subprocess
-from collections import Counter
 from enum import Enum
 
 from prometheus_client import (
@@ -48,11 +47,16 @@ class NeedRestartData:
         self.kernel_expected_version = ""
         self.microcode_current_version = ""
         self.microcode_expected_version = ""
-        needrestart_counter = Counter()
-
-        # Parse the cmd output
-        for line in needrestart_output.splitlines():
-            key, value = line.split(": ", maxsplit=1)
+        self.services_count = 0
+        self.containers_count = 0
+        self.sessions_count = 0
+
+        # Parse the cmd output, one line at a time
+        for line in needrestart_output:
+            key, separator, value = line.rstrip("\n").partition(": ")
+            # Skip anything that is not a "KEY: value" line
+            if not separator:
+                continue
             if key == "NEEDRESTART-VER":
                 self.version = value
             # Kernel informations
@@ -69,13 +73,13 @@ class NeedRestartData:
                 self.microcode_expected_version = value
             elif key == "NEEDRESTART-UCSTA":
                 self.microcode_status = MicroCodeStatus(int(value))
-            # Count the others
-            else:
-                needrestart_counter.update({key})
-
-        self.services_count = needrestart_counter["NEEDRESTART-SVC"]
-        self.containers_count = needrestart_counter["NEEDRESTART-CONT"]
-        self.sessions_count = needrestart_counter["NEEDRESTART-SESS"]
+            # Count services, containers and sessions needing a restart
+            elif key == "NEEDRESTART-SVC":
+                self.services_count += 1
+            elif key == "NEEDRESTART-CONT":
+                self.containers_count += 1
+            elif key == "NEEDRESTART-SESS":
+                self.sessions_count += 1
 
 
 def write_timestamp(registry, needrestart_data):
@@ -147,10 +151,17 @@ def main():
     registry = CollectorRegistry()
 
     try:
-        needrestart_output = subprocess.run(
-            ["needrestart", "-b"], capture_output=True, text=True, check=True
-        ).stdout
-        needrestart_data = NeedRestartData(needrestart_output)
+        # Parse the output while needrestart is still producing it, rather than
+        # buffering all of it first.
+        with subprocess.Popen(
+            ["needrestart", "-b"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ) as process:
+            needrestart_data = NeedRestartData(process.stdout)
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
     except subprocess.CalledProcessError as e:
         print(f"Error executing needrestart:\n{e}", file=sys.stderr)
         sys.exit(1)
@@ -165,7 +176,7 @@ def main():
     write_containers(registry, needrestart_data)
     write_sessions(registry, needrestart_data)
 
-    print(generate_latest(registry).decode(), end="")
+    sys.stdout.buffer.write(generate_latest(registry))
 
 
 if __name__ == "__main__":
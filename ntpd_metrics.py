@@ -6,7 +6,8 @@
 import re
 import subprocess
 import sys
-from prometheus_client import CollectorRegistry, Gauge, generate_latest
+from prometheus_client import CollectorRegistry, generate_latest
+from prometheus_client.core import GaugeMetricFamily
 
 # NTP peers status, with no DNS lookups.
 ntpq_cmd = ['ntpq', '-np', '-W', '255']
@@ -25,7 +26,8 @@ metrics_fields = [
     r'(?P<offset>-?\d+\.\d+)',
     r'(?P<jitter>\d+\.\d+)',
 ]
-metrics_re = r'\s+'.join(metrics_fields)
+# Fields are separated by blanks only, so that a match never spans multiple lines.
+metrics_re = re.compile(r'[ \t]+'.join(metrics_fields), re.MULTILINE)
 
 # Remote types
 # http://support.ntp.org/bin/view/Support/TroubleshootingNTP
@@ -51,6 +53,16 @@ status_types = {
 }
 
 
+class _StaticCollector:
+    """Collector returning metric families that have been filled in already."""
+
+    def __init__(self, *families):
+        self._families = families
+
+    def collect(self):
+        return self._families
+
+
 # Run the ntpq command.
 def get_output(command):
     try:
@@ -60,17 +72,16 @@ def get_output(command):
     return output.decode()
 
 
-# Parse raw ntpq lines.
-def parse_line(line):
-    if re.match(r'\s+remote\s+refid', line):
-        return None
-    if re.match(r'=+', line):
-        return None
-    if re.match(r'.+\.(LOCL|POOL)\.', line):
-        return None
-    if re.match(r'^$', line):
-        return None
-    return re.match(metrics_re, line)
+# Parse raw ntpq output, yielding the fields of each peer line in the order of
+# metrics_fields.
+def parse_peers(output):
+    # The header, separator and empty lines never match metrics_re, but local
+    # clocks and pool entries would.
+    for metric_match in metrics_re.finditer(output):
+        line = metric_match.group(0)
+        if '.LOCL.' in line or '.POOL.' in line:
+            continue
+        yield metric_match.groups()
 
 
 # Main function
@@ -79,40 +90,46 @@ def main(argv):
 
     namespace = 'ntpd'
     registry = CollectorRegistry()
-    peer_status = Gauge('peer_status', 'NTPd metric for peer_status',
-                        ['remote', 'reference', 'stratum', 'type'],
-                        namespace=namespace, registry=registry)
-    delay_ms = Gauge('delay_milliseconds', 'NTPd metric for delay_milliseconds',
-                     ['remote', 'reference'], namespace=namespace, registry=registry)
-    offset_ms = Gauge('offset_milliseconds', 'NTPd metric for offset_milliseconds',
-                      ['remote', 'reference'], namespace=namespace, registry=registry)
-    jitter_ms = Gauge('jitter_milliseconds', 'NTPd metric for jitter_milliseconds',
-                      ['remote', 'reference'], namespace=namespace, registry=registry)
-
-    for line in ntpq.split('\n'):
-        metric_match = parse_line(line)
-        if metric_match is None:
-            continue
-        remote = metric_match.group('remote')
-        refid = metric_match.group('refid')
-        stratum = metric_match.group('stratum')
-        remote_type = remote_types[metric_match.group('type')]
-
-        peer_status.labels(remote, refid, stratum, remote_type).set(
-            status_types[metric_match.group('status')]
-        )
-        delay_ms.labels(remote, refid).set(metric_match.group('delay'))
-        offset_ms.labels(remote, refid).set(metric_match.group('offset'))
-        jitter_ms.labels(remote, refid).set(metric_match.group('jitter'))
+    peer_status = GaugeMetricFamily('ntpd_peer_status', 'NTPd metric for peer_status',
+                                    labels=['remote', 'reference', 'stratum', 'type'])
+    delay_ms = GaugeMetricFamily('ntpd_delay_milliseconds', 'NTPd metric for delay_milliseconds',
+                                 labels=['remote', 'reference'])
+    offset_ms = GaugeMetricFamily('ntpd_offset_milliseconds',
+                                  'NTPd metric for offset_milliseconds',
+                                  labels=['remote', 'reference'])
+    jitter_ms = GaugeMetricFamily('ntpd_jitter_milliseconds',
+                                  'NTPd metric for jitter_milliseconds',
+                                  labels=['remote', 'reference'])
+
+    # The samples are keyed by their labels, so that a peer listed more than once yields a
+    # single series with the last value, rather than duplicate series.
+    peer_statuses, delays, offsets, jitters = {}, {}, {}, {}
+    for (status, remote, refid, stratum, remote_type,
+         _when, _poll, _reach, delay, offset, jitter) in parse_peers(ntpq):
+        peer_statuses[remote, refid, stratum, remote_types[remote_type]] = status_types[status]
+        delays[remote, refid] = float(delay)
+        offsets[remote, refid] = float(offset)
+        jitters[remote, refid] = float(jitter)
+
+    families = [peer_status, delay_ms, offset_ms, jitter_ms]
+    for family, values in zip(families, (peer_statuses, delays, offsets, jitters)):
+        for labels, value in values.items():
+            family.add_metric(labels, value)
 
     ntpq_rv = get_output(ntpq_rv_cmd)
+    rv_values = {}
     for metric in ntpq_rv.split(','):
         metric_name, metric_value = metric.strip().split('=')
-        g = Gauge(metric_name, 'NTPd metric for {}'.format(metric_name), [],
-                  namespace=namespace, registry=registry)
-        g.set(metric_value)
+        rv_values[metric_name] = float(metric_value)
+
+    for metric_name, metric_value in rv_values.items():
+        families.append(GaugeMetricFamily('{}_{}'.format(namespace, metric_name),
+                                          'NTPd metric for {}'.format(metric_name),
+                                          value=metric_value))
+
+    registry.register(_StaticCollector(*families))
 
-    print(generate_latest(registry).decode(), end='')
+    sys.stdout.buffer.write(generate_latest(registry))
 
 
 # Go go go!
@@ -13,6 +13,7 @@ import os
 import re
 import sys
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 # Disable automatic addition of _created series. Must be set before importing prometheus_client.
 os.environ["PROMETHEUS_DISABLE_CREATED_SERIES"] = "true"
@@ -22,112 +23,108 @@ from prometheus_client import CollectorRegistry, Counter, Gauge, Info, generate_
 registry = CollectorRegistry()
 namespace = "nvme"
 
-metrics = {
+# Environment for nvme child processes, built once rather than for every invocation.
+nvme_env = dict(os.environ, LC_ALL="C")
+
+# Metric key, type, name, documentation and label names of every exported metric.
+metric_specs = [
     # fmt: off
-    "avail_spare": Gauge(
-        "available_spare_ratio",
-        "Device available spare ratio",
-        ["device"], namespace=namespace, registry=registry,
-    ),
-    "controller_busy_time": Counter(
-        "controller_busy_time_seconds",
-        "Device controller busy time in seconds",
-        ["device"], namespace=namespace, registry=registry,
-    ),
-    "critical_warning": Gauge(
-        "critical_warning",
-        "Device critical warning bitmap field",
-        ["device"], namespace=namespace, registry=registry,
-    ),
-    "data_units_read": Counter(
-        "data_units_read_total",
-        "Number of 512-byte data units read by host, reported in thousands",
-        ["device"], namespace=namespace, registry=registry,
-    ),
-    "data_units_written": Counter(
-        "data_units_written_total",
-        "Number of 512-byte data units written by host, reported in thousands",
-        ["device"], namespace=namespace, registry=registry,
-    ),
-    "device_info": Info(
-        "device",
-        "Device information",
-        ["device", "model", "firmware", "serial"], namespace=namespace, registry=registry,
-    ),
-    "host_read_commands": Counter(
-        "host_read_commands_total",
-        "Device read commands from host",
-        ["device"], namespace=namespace, registry=registry,
-    ),
-    "host_write_commands": Counter(
-        "host_write_commands_total",
-        "Device write commands from host",
-        ["device"], namespace=namespace, registry=registry,
-    ),
-    "media_errors": Counter(
-        "media_errors_total",
-        "Device media errors total",
-        ["device"], namespace=namespace, registry=registry,
-    ),
-    "num_err_log_entries": Counter(
-        "num_err_log_entries_total",
-        "Device error log entry count",
-        ["device"], namespace=namespace, registry=registry,
-    ),
+    ("avail_spare", Gauge, "available_spare_ratio",
+     "Device available spare ratio",
+     ["device"]),
+    ("controller_busy_time", Counter, "controller_busy_time_seconds",
+     "Device controller busy time in seconds",
+     ["device"]),
+    ("critical_warning", Gauge, "critical_warning",
+     "Device critical warning bitmap field",
+     ["device"]),
+    ("data_units_read", Counter, "data_units_read_total",
+     "Number of 512-byte data units read by host, reported in thousands",
+     ["device"]),
+    ("data_units_written", Counter, "data_units_written_total",
+     "Number of 512-byte data units written by host, reported in thousands",
+     ["device"]),
+    ("device_info", Info, "device",
+     "Device information",
+     ["device", "model", "firmware", "serial"]),
+    ("host_read_commands", Counter, "host_read_commands_total",
+     "Device read commands from host",
+     ["device"]),
+    ("host_write_commands", Counter, "host_write_commands_total",
+     "Device write commands from host",
+     ["device"]),
+    ("media_errors", Counter, "media_errors_total",
+     "Device media errors total",
+     ["device"]),
+    ("num_err_log_entries", Counter, "num_err_log_entries_total",
+     "Device error log entry count",
+     ["device"]),
     # FIXME: The "nvmecli" metric ought to be an Info type, not a Gauge. However, making this change
     # will result in the metric having a "_info" suffix automatically appended, which is arguably
     # a breaking change.
-    "nvmecli": Gauge(
-        "nvmecli",
-        "nvme-cli tool information",
-        ["version"], namespace=namespace, registry=registry,
-    ),
-    "percent_used": Gauge(
-        "percentage_used_ratio",
-        "Device percentage used ratio",
-        ["device"], namespace=namespace, registry=registry,
-    ),
-    "physical_size": Gauge(
-        "physical_size_bytes",
-        "Device size in bytes",
-        ["device"], namespace=namespace, registry=registry,
-    ),
-    "power_cycles": Counter(
-        "power_cycles_total",
-        "Device number of power cycles",
-        ["device"], namespace=namespace, registry=registry,
-    ),
-    "power_on_hours": Counter(
-        "power_on_hours_total",
-        "Device power-on hours",
-        ["device"], namespace=namespace, registry=registry,
-    ),
-    "sector_size": Gauge(
-        "sector_size_bytes",
-        "Device sector size in bytes",
-        ["device"], namespace=namespace, registry=registry,
-    ),
-    "spare_thresh": Gauge(
-        "available_spare_threshold_ratio",
-        "Device available spare threshold ratio",
-        ["device"], namespace=namespace, registry=registry,
-    ),
-    "temperature": Gauge(
-        "temperature_celsius",
-        "Device temperature in degrees Celsius",
-        ["device"], namespace=namespace, registry=registry,
-    ),
-    "unsafe_shutdowns": Counter(
-        "unsafe_shutdowns_total",
-        "Device number of unsafe shutdowns",
-        ["device"], namespace=namespace, registry=registry,
-    ),
-    "used_bytes": Gauge(
-        "used_bytes",
-        "Device used size in bytes",
-        ["device"], namespace=namespace, registry=registry,
-    ),
+    ("nvmecli", Gauge, "nvmecli",
+     "nvme-cli tool information",
+     ["version"]),
+    ("percent_used", Gauge, "percentage_used_ratio",
+     "Device percentage used ratio",
+     ["device"]),
+    ("physical_size", Gauge, "physical_size_bytes",
+     "Device size in bytes",
+     ["device"]),
+    ("power_cycles", Counter, "power_cycles_total",
+     "Device number of power cycles",
+     ["device"]),
+    ("power_on_hours", Counter, "power_on_hours_total",
+     "Device power-on hours",
+     ["device"]),
+    ("sector_size", Gauge, "sector_size_bytes",
+     "Device sector size in bytes",
+     ["device"]),
+    ("spare_thresh", Gauge, "available_spare_threshold_ratio",
+     "Device available spare threshold ratio",
+     ["device"]),
+    ("temperature", Gauge, "temperature_celsius",
+     "Device temperature in degrees Celsius",
+     ["device"]),
+    ("unsafe_shutdowns", Counter, "unsafe_shutdowns_total",
+     "Device number of unsafe shutdowns",
+     ["device"]),
+    ("used_bytes", Gauge, "used_bytes",
+     "Device used size in bytes",
+     ["device"]),
     # fmt: on
+]
+
+metrics = {
+    key: metric_type(name, documentation, labelnames, namespace=namespace, registry=registry)
+    for key, metric_type, name, documentation, labelnames in metric_specs
+}
+
+# Metrics taken from the smart-log, keyed by the name of both the metric and the smart-log field,
+# with a function converting the field value to the metric value.
+#
+# Various counters in the NVMe specification are 128-bit, which would have to discard resolution if
+# converted to a JSON number (i.e., float64_t). Instead, nvme-cli marshals them as strings. As such,
+# they need to be explicitly cast to int or float when using them in Counter metrics.
+smart_log_counters = {
+    "controller_busy_time": int,
+    "data_units_read": int,
+    "data_units_written": int,
+    "host_read_commands": int,
+    "host_write_commands": int,
+    "media_errors": int,
+    "num_err_log_entries": int,
+    "power_cycles": int,
+    "power_on_hours": int,
+    "unsafe_shutdowns": int,
+}
+smart_log_gauges = {
+    "avail_spare": lambda value: value / 100,
+    "critical_warning": lambda value: value["value"],
+    "percent_used": lambda value: value / 100,
+    "spare_thresh": lambda value: value / 100,
+    # NVMe reports temperature in kelvins; convert it to degrees Celsius.
+    "temperature": lambda value: value - 273,
 }
 
 
@@ -135,10 +132,10 @@ def exec_nvme(*args):
     """
     Execute nvme CLI tool with specified arguments and return captured stdout result. Set LC_ALL=C
     in child process environment so that the nvme tool does not perform any locale-specific number
-    or date formatting, etc.
+    or date formatting, etc. The error output is discarded, since it is not used.
     """
     cmd = ["nvme", *args]
-    return subprocess.check_output(cmd, stderr=subprocess.PIPE, env=dict(os.environ, LC_ALL="C"))
+    return subprocess.check_output(cmd, stderr=subprocess.DEVNULL, env=nvme_env)
 
 
 def exec_nvme_json(*args):
@@ -153,19 +150,59 @@ def exec_nvme_json(*args):
     return json.loads(output)
 
 
+def fetch_smart_logs(device_names):
+    """
+    Fetch the smart-log of each of the given devices, returning a dict keyed by device name. The
+    nvme invocations are run concurrently, since each of them mostly waits for the device.
+    """
+    if not device_names:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(8, len(device_names))) as executor:
+        smart_logs = executor.map(
+            lambda name: exec_nvme_json("smart-log", os.path.join("/dev", name)), device_names
+        )
+        return dict(zip(device_names, smart_logs))
+
+
 def main():
-    match = re.match(r"^nvme version (\S+)", exec_nvme("version").decode())
+    match = re.match(rb"^nvme version (\S+)", exec_nvme("version"))
     if match:
-        cli_version = match.group(1)
+        cli_version = match.group(1).decode()
     else:
         cli_version = "unknown"
     metrics["nvmecli"].labels(cli_version).set(1)
 
     device_list = exec_nvme_json("list")
 
+    # The smart-log is controller-wide, so only fetch it once per controller (via its first
+    # namespace). In order to preserve legacy metric labels, its metrics are still exported for
+    # every namespace.
+    smart_logs = fetch_smart_logs(
+        [
+            ctrl["Namespaces"][0]["NameSpace"]
+            for device in device_list["Devices"]
+            for subsys in device["Subsystems"]
+            for ctrl in subsys["Controllers"]
+            if ctrl["Namespaces"]
+        ]
+    )
+
     for device in device_list["Devices"]:
         for subsys in device["Subsystems"]:
             for ctrl in subsys["Controllers"]:
+                if not ctrl["Namespaces"]:
+                    continue
+                smart_log = smart_logs[ctrl["Namespaces"][0]["NameSpace"]]
+                # Convert the smart-log values once, they are the same for every namespace.
+                smart_log_counter_values = [
+                    (metrics[key], convert(smart_log[key]))
+                    for key, convert in smart_log_counters.items()
+                ]
+                smart_log_gauge_values = [
+                    (metrics[key], convert(smart_log[key]))
+                    for key, convert in smart_log_gauges.items()
+                ]
+
                 for ns in ctrl["Namespaces"]:
                     device_name = ns["NameSpace"]
 
@@ -184,50 +221,10 @@ def main():
                     metrics["physical_size"].labels(device_name).set(ns["PhysicalSize"])
                     metrics["used_bytes"].labels(device_name).set(ns["UsedBytes"])
 
-                    # FIXME: The smart-log should only need to be fetched once per controller, not
-                    # per namespace. However, in order to preserve legacy metric labels, fetch it
-                    # per namespace anyway. Most consumer grade SSDs will only have one namespace.
-                    smart_log = exec_nvme_json("smart-log", os.path.join("/dev", device_name))
-
-                    # Various counters in the NVMe specification are 128-bit, which would have to
-                    # discard resolution if converted to a JSON number (i.e., float64_t). Instead,
-                    # nvme-cli marshals them as strings. As such, they need to be explicitly cast
-                    # to int or float when using them in Counter metrics.
-                    metrics["data_units_read"].labels(device_name).inc(
-                        int(smart_log["data_units_read"])
-                    )
-                    metrics["data_units_written"].labels(device_name).inc(
-                        int(smart_log["data_units_written"])
-                    )
-                    metrics["host_read_commands"].labels(device_name).inc(
-                        int(smart_log["host_read_commands"])
-                    )
-                    metrics["host_write_commands"].labels(device_name).inc(
-                        int(smart_log["host_write_commands"])
-                    )
-                    metrics["avail_spare"].labels(device_name).set(smart_log["avail_spare"] / 100)
-                    metrics["spare_thresh"].labels(device_name).set(smart_log["spare_thresh"] / 100)
-                    metrics["percent_used"].labels(device_name).set(smart_log["percent_used"] / 100)
-                    metrics["critical_warning"].labels(device_name).set(
-                        smart_log["critical_warning"]["value"]
-                    )
-                    metrics["media_errors"].labels(device_name).inc(int(smart_log["media_errors"]))
-                    metrics["num_err_log_entries"].labels(device_name).inc(
-                        int(smart_log["num_err_log_entries"])
-                    )
-                    metrics["power_cycles"].labels(device_name).inc(int(smart_log["power_cycles"]))
-                    metrics["power_on_hours"].labels(device_name).inc(
-                        int(smart_log["power_on_hours"])
-                    )
-                    metrics["controller_busy_time"].labels(device_name).inc(
-                        int(smart_log["controller_busy_time"])
-                    )
-                    metrics["unsafe_shutdowns"].labels(device_name).inc(
-                        int(smart_log["unsafe_shutdowns"])
-                    )
-
-                    # NVMe reports temperature in kelvins; convert it to degrees Celsius.
-                    metrics["temperature"].labels(device_name).set(smart_log["temperature"] - 273)
+                    for metric, value in smart_log_counter_values:
+                        metric.labels(device_name).inc(value)
+                    for metric, value in smart_log_gauge_values:
+                        metric.labels(device_name).set(value)
 
 
 if __name__ == "__main__":
@@ -248,4 +245,4 @@ if __name__ == "__main__":
         print("ERROR: {}".format(e), file=sys.stderr)
         sys.exit(1)
 
-    print(generate_latest(registry).decode(), end="")
+    sys.stdout.buffer.write(generate_latest(registry))
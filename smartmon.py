@@ -2,11 +2,11 @@
 
 import argparse
 import collections
-import csv
 import re
 import shlex
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from prometheus_client import CollectorRegistry, Gauge, generate_latest
 
 device_info_re = re.compile(r'^(?P<k>[^:]+?)(?:(?:\sis|):)\s*(?P<v>.*)$')
@@ -16,6 +16,18 @@ ata_error_count_re = re.compile(
 
 self_test_re = re.compile(r'^SMART.*(PASSED|OK)$', re.MULTILINE)
 
+information_section_re = re.compile(
+    r'^=== START OF INFORMATION SECTION ===$(.*?)(?:^=== START OF |\Z)',
+    re.MULTILINE | re.DOTALL)
+
+# Matches the rows of the SMART attributes table, e.g.:
+# 194 Temperature_Celsius 0x0022 036 052 000 Old_age Always - 36 (Min/Max 24/40)
+# Only the numeric part of the raw value is captured, since values such as
+# "36 (Min/Max 24/40)" can't be expressed properly as a prometheus metric.
+# Rows whose raw value does not start with a number are not matched at all.
+smart_attribute_re = re.compile(
+    r'^[ \t]*(\d+)' + r'[ \t]+(\S+)' * 8 + r'[ \t]+(\d+)', re.MULTILINE)
+
 device_info_map = {
     'Vendor': 'vendor',
     'Product': 'product',
@@ -258,31 +270,57 @@ def device_is_active(device):
     return True
 
 
-def device_info(device):
-    """Query device for basic model information.
+def device_report(device):
+    """Query device for everything collected about it in a single smartctl run.
 
     Args:
         device: (Device) Device in question.
 
+    Returns:
+        (str) smartctl output, consisting of the device information and health
+        self-assessment, followed by the SMART attributes and the extended
+        error log for ATA devices.
+    """
+    args = ['--info', '--health']
+    if device.type.startswith('sat'):
+        args.extend(['--attributes', '-l', 'xerror,1'])
+
+    result = subprocess.run(
+        ['smartctl', *args, *device.smartctl_select()], stdout=subprocess.PIPE)
+
+    # Only bits 0 and 1 of the exit status report that smartctl could not
+    # query the device, the others reflect the health and error log state
+    # which is exported as metrics.
+    if result.returncode & 0b11:
+        raise subprocess.CalledProcessError(result.returncode, result.args)
+
+    return result.stdout.decode('utf-8')
+
+
+def device_info(report):
+    """Parse basic model information.
+
+    Args:
+        report: (str) smartctl output for the device.
+
     Returns:
         (generator): Generator yielding:
 
             key (str): Key describing the value.
             value (str): Actual value.
     """
-    info_lines = smart_ctl(
-        '--info', *device.smartctl_select()
-    ).strip().split('\n')[3:]
+    m = information_section_re.search(report)
+    info_lines = m.group(1).split('\n') if m is not None else []
 
     matches = (device_info_re.match(line) for line in info_lines)
     return (m.groups() for m in matches if m is not None)
 
 
-def device_smart_capabilities(device):
+def device_smart_capabilities(report):
     """Returns SMART capabilities of the given device.
 
     Args:
-        device: (Device) Device in question.
+        report: (str) smartctl output for the device.
 
     Returns:
         (tuple): tuple containing:
@@ -290,7 +328,7 @@ def device_smart_capabilities(device):
             (bool): True whenever SMART is available, False otherwise.
             (bool): True whenever SMART is enabled, False otherwise.
     """
-    groups = device_info(device)
+    groups = device_info(report)
 
     state = {
         g[1].split(' ', 1)[0]
@@ -302,13 +340,14 @@ def device_smart_capabilities(device):
     return smart_available, smart_enabled
 
 
-def collect_device_info(device):
+def collect_device_info(device, report):
     """Collect basic device information.
 
     Args:
         device: (Device) Device in question.
+        report: (str) smartctl output for the device.
     """
-    values = dict(device_info(device))
+    values = dict(device_info(report))
     metrics["device_info"].labels(
         device.base_labels["device"],
         device.base_labels["disk"],
@@ -323,85 +362,55 @@ def collect_device_info(device):
     ).set(1)
 
 
-def collect_device_health_self_assessment(device):
+def collect_device_health_self_assessment(device, report):
     """Collect metric about the device health self assessment.
 
     Args:
         device: (Device) Device in question.
+        report: (str) smartctl output for the device.
     """
-    out = smart_ctl('--health', *device.smartctl_select(), check=False)
-
-    self_assessment_passed = bool(self_test_re.search(out))
+    self_assessment_passed = bool(self_test_re.search(report))
     metrics["device_smart_healthy"].labels(
         device.base_labels["device"], device.base_labels["disk"]
     ).set(self_assessment_passed)
 
 
-def collect_ata_metrics(device):
-    # Fetch SMART attributes for the given device.
-    attributes = smart_ctl(
-        '--attributes', *device.smartctl_select()
-    )
-
-    # replace multiple occurrences of whitespace with a single whitespace
-    # so that the CSV Parser recognizes individual columns properly.
-    attributes = re.sub(r'[\t\x20]+', ' ', attributes)
-
-    # Turn smartctl output into a list of lines and skip to the table of
-    # SMART attributes.
-    attribute_lines = attributes.strip().split('\n')[7:]
-
+def collect_ata_metrics(device, report):
     # Some attributes have multiple IDs but have the same name.  Don't
     # yield attributes that already have been reported before.
     seen = set()
 
-    reader = csv.DictReader(
-        (line.strip() for line in attribute_lines),
-        fieldnames=SmartAttribute._fields[:-1],
-        restkey=SmartAttribute._fields[-1], delimiter=' ')
-    for entry in reader:
+    for attribute in map(SmartAttribute._make, smart_attribute_re.findall(report)):
         # We're only interested in the SMART attributes that are
         # whitelisted here.
-        entry['name'] = entry['name'].lower()
-        if entry['name'] not in smart_attributes_whitelist:
+        name = attribute.name.lower()
+        if name not in smart_attributes_whitelist or name in seen:
             continue
 
-        # Ensure that only the numeric parts are fetched from the raw_value.
-        # Attributes such as 194 Temperature_Celsius reported by my SSD
-        # are in the format of "36 (Min/Max 24/40)" which can't be expressed
-        # properly as a prometheus metric.
-        m = re.match(r'^(\d+)', ' '.join(entry['raw_value']))
-        if not m:
-            continue
-        entry['raw_value'] = m.group(1)
-
         # Some device models report "---" in the threshold value where most
         # devices would report "000". We do the substitution here because
         # downstream code expects values to be convertable to integer.
-        if entry['threshold'] == '---':
-            entry['threshold'] = '0'
+        threshold = '0' if attribute.threshold == '---' else attribute.threshold
 
-        if entry['name'] in smart_attributes_whitelist and entry['name'] not in seen:
-            for col in 'value', 'worst', 'threshold', 'raw_value':
-                metrics["attr_" + col].labels(
-                    device.base_labels["device"],
-                    device.base_labels["disk"],
-                    entry["name"],
-                ).set(entry[col])
+        for col, value in (('value', attribute.value), ('worst', attribute.worst),
+                           ('threshold', threshold), ('raw_value', attribute.raw_value)):
+            metrics["attr_" + col].labels(
+                device.base_labels["device"],
+                device.base_labels["disk"],
+                name,
+            ).set(value)
 
-            seen.add(entry['name'])
+        seen.add(name)
 
 
-def collect_ata_error_count(device):
+def collect_ata_error_count(device, report):
     """Inspect the device error log and report the amount of entries.
 
     Args:
         device: (Device) Device in question.
+        report: (str) smartctl output for the device.
     """
-    error_log = smart_ctl(
-        '-l', 'xerror,1', *device.smartctl_select(), check=False)
-
-    m = ata_error_count_re.search(error_log)
+    m = ata_error_count_re.search(report)
 
     error_count = m.group(1) if m is not None else 0
     metrics["device_errors"].labels(
@@ -409,20 +418,49 @@ def collect_ata_error_count(device):
     ).set(error_count)
 
 
+def query_device(device, wakeup_disks):
+    """Run the smartctl queries for the given device.
+
+    Args:
+        device: (Device) Device in question.
+        wakeup_disks: (bool) Whether to query the device even if it is in standby.
+
+    Returns:
+        (tuple): tuple containing:
+
+            (bool): True whenever the device is active, False otherwise.
+            (str): smartctl output for the device, None if it was not queried.
+    """
+    is_active = device_is_active(device)
+
+    # Skip further queries to prevent the disk from spinning up.
+    if not is_active and not wakeup_disks:
+        return is_active, None
+
+    return is_active, device_report(device)
+
+
 def collect_disks_smart_metrics(wakeup_disks, by_id):
-    for device in find_devices(by_id):
-        is_active = device_is_active(device)
+    devices = list(find_devices(by_id))
+    if not devices:
+        return
+
+    # smartctl spends most of its time waiting for the devices, so query them
+    # concurrently. The metrics are only updated from this thread.
+    with ThreadPoolExecutor(max_workers=min(16, len(devices))) as executor:
+        results = list(executor.map(lambda d: query_device(d, wakeup_disks), devices))
+
+    for device, (is_active, report) in zip(devices, results):
         metrics["device_active"].labels(
             device.base_labels["device"], device.base_labels["disk"],
         ).set(is_active)
 
-        # Skip further metrics collection to prevent the disk from spinning up.
-        if not is_active and not wakeup_disks:
+        if report is None:
             continue
 
-        collect_device_info(device)
+        collect_device_info(device, report)
 
-        smart_available, smart_enabled = device_smart_capabilities(device)
+        smart_available, smart_enabled = device_smart_capabilities(report)
 
         metrics["device_smart_available"].labels(
             device.base_labels["device"], device.base_labels["disk"]
@@ -437,11 +475,11 @@ def collect_disks_smart_metrics(wakeup_disks, by_id):
         if not smart_available:
             continue
 
-        collect_device_health_self_assessment(device)
+        collect_device_health_self_assessment(device, report)
 
         if device.type.startswith('sat'):
-            collect_ata_metrics(device)
-            collect_ata_error_count(device)
+            collect_ata_metrics(device, report)
+            collect_ata_error_count(device, report)
 
 
 def main():
@@ -455,7 +493,7 @@ def main():
     metrics["smartctl_version"].labels(smart_ctl_version()).set(1)
 
     collect_disks_smart_metrics(args.wakeup_disks, args.by_id)
-    print(generate_latest(registry).decode(), end="")
+    sys.stdout.buffer.write(generate_latest(registry))
 
 
 if __name__ == '__main__':
@@ -21,6 +21,7 @@ import json
 import os
 import shlex
 import subprocess
+import sys
 from datetime import datetime
 
 from prometheus_client import CollectorRegistry, Gauge, generate_latest
@@ -203,7 +204,7 @@ def main(args):
     except KeyError:
         pass
 
-    print(generate_latest(registry).decode(), end="")
+    sys.stdout.buffer.write(generate_latest(registry))
 
 
 def handle_common_controller(response):
@@ -28,28 +28,40 @@ __version__ = '0.1.0'
 
 BIN = None
 METRICS = {}
+RUN_CACHE = {}
 METRIC_PREFIX = 'tw_cli'
+PROMPT_RE = re.compile(r'^//.*?> ')
+NUMBER_RE = re.compile(r'\d+')
+# Escape sequences required for label values by the Prometheus text exposition format.
+LABEL_VALUE_ESCAPES = str.maketrans({'\\': '\\\\', '"': '\\"', '\n': '\\n'})
+
+
+def write_metrics():
+    """Writes out the metrics collected so far"""
+    sys.stdout.flush()
+    sys.stdout.buffer.write(''.join(
+        '{}\t{}\n'.format(series, value) for series, value in METRICS.items()).encode())
+    METRICS.clear()
 
 
 def exit_error(msg):
+    # Keep whatever was collected before the error, so that partial data is not lost.
+    write_metrics()
     print('{}_cli_error{{message="{}"}}\t1'.format(METRIC_PREFIX, msg))
     sys.exit(1)
 
 
 def exit_clean():
-    global METRICS
-    for mk, mv in METRICS.items():
-        print('{}_{}\t{}'.format(METRIC_PREFIX, mk, mv))
+    write_metrics()
     sys.exit(0)
 
 
 def add_metric(metric, labels, value):
-    global METRICS
-    labelstrs = []
-    for lk, lv in labels.items():
-        labelstrs += ['{}="{}"'.format(lk, lv)]
-    labelstr = ','.join(labelstrs)
-    METRICS[metric + '{' + labelstr + '}'] = str(value)
+    labelstr = ','.join('{}="{}"'.format(lk, str(lv).translate(LABEL_VALUE_ESCAPES))
+                        for lk, lv in labels.items())
+    # Keyed by the series, so that a repeated series overwrites the earlier value rather than
+    # producing a duplicate sample.
+    METRICS['{}_{}{{{}}}'.format(METRIC_PREFIX, metric, labelstr)] = value
 
 
 def _set_twcli_binary():
@@ -59,9 +71,24 @@ def _set_twcli_binary():
 
 
 def run(cmd, stripOutput=True):
-    """Runs a system command and returns stripped output"""
+    """Runs a 3ware utility command and returns stripped output. The output of each command is
+    cached, since several collectors issue the same query (e.g. 'show') and every run of the
+    utility is a separate process that has to re-probe the controllers."""
     if not cmd:
         exit_error("Internal python error - no cmd supplied for 3ware utility")
+
+    if cmd not in RUN_CACHE:
+        RUN_CACHE[cmd] = _run_twcli(cmd)
+    output = RUN_CACHE[cmd]
+
+    if stripOutput:
+        return output[3:-2]
+
+    return output
+
+
+def _run_twcli(cmd):
+    """Runs a 3ware utility command and returns its complete output as a list of lines"""
     try:
         process = Popen(BIN, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
     except OSError as error:
@@ -75,28 +102,26 @@ def run(cmd, stripOutput=True):
         exit_error("3ware utility process ended prematurely")
 
     try:
-        stdout, stderr = process.communicate(cmd)
+        stdout, stderr = process.communicate(cmd.encode())
     except OSError as error:
         exit_error("Unable to communicate with 3ware utility - {}".format(error))
 
     if not stdout:
         exit_error("No output from 3ware utility")
 
-    output = str(stdout).split('\n')
-    # Strip command prompt, since we're running an interactive CLI shell
-    output[0] = re.sub(r'//.*?> ', '', output[0])
+    stdout = stdout.decode('utf-8', errors='replace')
+    # Strip command prompts, since we're running an interactive CLI shell. A prompt is printed
+    # ahead of the output of each command, so there is one per command passed on stdin.
+    output = [PROMPT_RE.sub('', line) for line in stdout.split('\n')]
 
     if output[1] == "No controller found.":
         exit_error("No 3ware controllers were found on this machine")
 
     if process.returncode != 0:
-        stderr = str(stdout).replace('\n', ' ')
+        stderr = stdout.replace('\n', ' ')
         exit_error("3ware utility returned an exit code of {} - {}".format(process.returncode,
                                                                            stderr))
 
-    if stripOutput:
-        return output[3:-2]
-
     return output
 
 
@@ -188,8 +213,9 @@ def test_drives(verbosity, warn_true=False):
 
 
 def _parse_temperature(val):
-    result = re.split(r'(\d+)(.*)$', val)
-    return result[1]
+    """Returns the temperature in val, or None if it does not contain one (e.g. 'N/A')"""
+    m = NUMBER_RE.search(val)
+    return m.group() if m else None
 
 
 def _parse_yes_ok_on(val):
@@ -198,27 +224,32 @@ def _parse_yes_ok_on(val):
     return 0
 
 
-def collect_details(cmdprefix, detailsMap, metric, injectedLabels, verbosity):
+def collect_details(cmdprefix, detailsMap, metric, injectedLabels, verbosity, lines=None):
     """Generic function to parse key = value lists, based on a detailsMap which selects the fields
     to parse. injectedLabels is just baseline labels to be included. Note that the map may list both
     labels to append to a catchall 'metric', or individual metrics, whose name overrides 'metric'
-    and will contain injectedLabels."""
-    lines = run('{} show all'.format(cmdprefix), False)
+    and will contain injectedLabels. If lines is given, it is used instead of running
+    '<cmdprefix> show all'; only the lines belonging to cmdprefix are considered."""
+    if lines is None:
+        lines = run('{} show all'.format(cmdprefix), False)
     labels = copy.copy(injectedLabels)
+    detail_re = re.compile('^' + re.escape(cmdprefix) + ' (.+?)= (.+?)$')
     for line in lines:
-        if re.match('^' + cmdprefix + ' (.+?)= (.+?)$', line):
+        m = detail_re.match(line)
+        if m:
             if verbosity >= 3:
                 print(line)
-            result = re.split(r'\S+ (.+?)= (.+?)$', line)
-            # print("RESULT:", str(result))
-            k = result[1].strip()
-            v = result[2].strip()
+            k = m.group(1).strip()
+            v = m.group(2).strip()
             if k in detailsMap:
                 if detailsMap[k]['parser']:
                     v = detailsMap[k]['parser'](v)
                 # If this field is meant for a separate metric, do it
                 if 'metric' in detailsMap[k]:
-                    add_metric(detailsMap[k]['metric'], injectedLabels, v)
+                    # Skip values the parser could not make sense of, as a non-numeric sample
+                    # would invalidate the whole output.
+                    if v is not None:
+                        add_metric(detailsMap[k]['metric'], injectedLabels, v)
                 else:
                     labels[detailsMap[k]['label']] = v
     add_metric(metric, labels, 1)
@@ -256,11 +287,17 @@ def collect_drives(controller, verbosity):
         'Link Speed':          {'label': 'linkspeed', 'parser': None},
     }
     drive_lines = run('/' + controller + ' show drivestatus')
-    for drive_line in drive_lines:
-        drive_line = drive_line.split()
-        drive = drive_line[0]
+    drives = [drive_line.split()[0] for drive_line in drive_lines]
+    if not drives:
+        return
+
+    # Query the details of all drives in a single run of the 3ware utility. Each detail line is
+    # prefixed with the drive it belongs to, so collect_details() can pick out its own lines.
+    detail_lines = run('\n'.join('/{}/{} show all'.format(controller, drive) for drive in drives),
+                       False)
+    for drive in drives:
         collect_details('/' + controller + '/' + drive, DRIVE_DETAILS, 'drive_info',
-                        {'controller': controller[1:], 'drive': drive}, verbosity)
+                        {'controller': controller[1:], 'drive': drive}, verbosity, detail_lines)
 
 
 def collect_bbu(controller, verbosity):
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import os
 import subprocess
+import sys
 from functools import reduce, partial
 from itertools import groupby
 from operator import itemgetter, add
@@ -94,7 +95,7 @@ def main():
     collect_metrics(latest_time_metric, latest_time)
     collect_metrics(space_used_metric, space_used)
 
-    print(generate_latest(registry).decode(), end="")
+    sys.stdout.buffer.write(generate_latest(registry))
 
 
 if __name__ == "__main__":